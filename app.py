@@ -5,14 +5,27 @@ from flask import Flask, request, send_file, jsonify
 from flask_cors import CORS
 from docxtpl import DocxTemplate
 from docx2pdf import convert
+from charset_normalizer import from_bytes
 import pandas as pd
+
+# Polars читает CSV многопоточно и без GIL; без него работаем на pandas
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+import csv
 import os
 import re
 import io
+import subprocess
 import zipfile
 from werkzeug.utils import secure_filename
 import tempfile
 import shutil
+import time
+import uuid
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
 app = Flask(__name__)
@@ -20,39 +33,325 @@ CORS(app)
 
 # Конфигурация
 UPLOAD_FOLDER = tempfile.gettempdir()
-ALLOWED_EXTENSIONS = {'docx', 'csv'}
+ALLOWED_EXTENSIONS = frozenset({'docx', 'csv'})
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# Файлы, загруженные потоком через /api/upload-stream:
+# token -> (путь на диске, время загрузки). Токены, которые так и не
+# забрал /api/generate, выбрасываются по TTL вместе с файлами
+_UPLOADS = {}
+_UPLOAD_TTL = 3600
+
+# Хеши содержимого потоковых загрузок: token -> blake2b hexdigest
+_UPLOAD_HASHES = {}
+
+# Кеш детекта кодировки: hexdigest -> (кодировка, время записи).
+# preview и generate получают один и тот же CSV — детектим один раз
+_ENCODING_CACHE = {}
+_ENCODING_CACHE_TTL = 3600
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # rpartition вместо '.' in + rsplit: один проход и кортеж
+    # вместо аллокации списка
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+def remove_silent(path):
+    """Удаление файла одним unlink, без проверки существования.
+
+    Пара os.path.exists + os.remove — два syscall и гонка между ними;
+    FileNotFoundError просто глотаем.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+# Скомпилирован один раз: sanitize_filename зовется дважды на строку CSV
+_SANITIZE_RE = re.compile(r'[<>:"/\\|?*]')
 
 def sanitize_filename(filename):
     """Очистка имени файла от опасных символов"""
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+    return _SANITIZE_RE.sub('_', filename)
 
 def detect_csv_encoding(file_path):
-    """Определение кодировки CSV"""
-    encodings = ['utf-8', 'utf-8-sig', 'latin-1', 'cp1252', 'iso-8859-1']
-    for encoding in encodings:
-        try:
-            pd.read_csv(file_path, sep=';', encoding=encoding, nrows=1)
-            return encoding
-        except:
-            continue
+    """Определение кодировки CSV.
+
+    Вместо пробных запусков pd.read_csv (каждый открывает файл и
+    инициализирует C-парсер) читаем один раз 64 КБ: сначала проверяем
+    BOM, потом пробуем строгий utf-8, в крайнем случае отдаем выборку
+    charset_normalizer.
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(65536)
+
+    if sample.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if sample.startswith(b'\xff\xfe') or sample.startswith(b'\xfe\xff'):
+        return 'utf-16'
+
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    best = from_bytes(sample).best()
+    if best is not None and best.encoding:
+        return best.encoding
     return 'utf-8'
 
+def _compile_context_builder(resolved, columns):
+    """Генерирует функцию сборки контекста под конкретный шаблон и CSV.
+
+    Пары (переменная -> колонка) и набор колонок неизменны в рамках
+    запроса, поэтому вместо K проверок `in` и lookups маппинга на
+    каждую строку собираем прямолинейную функцию: присутствующие
+    колонки читаются напрямую, отсутствующие сразу получают
+    плейсхолдер-константу.
+    """
+    columns = set(columns)
+    parts = []
+    for var_name, csv_column in resolved:
+        if csv_column in columns:
+            parts.append(f"{var_name!r}: row[{csv_column!r}]")
+        else:
+            placeholder = f"[{var_name}]"
+            parts.append(f"{var_name!r}: {placeholder!r}")
+    source = "def _build(row):\n    return {" + ", ".join(parts) + "}\n"
+    namespace = {}
+    exec(source, namespace)
+    return namespace['_build']
+
+# Состояние процесса-воркера, заполняется в _init_worker
+_TPL_BYTES = None
+_BUILD_CONTEXT = None
+
+def _init_worker(tpl_bytes, resolved, columns):
+    """Инициализатор воркера: байты шаблона и специализированный
+    сборщик контекста готовятся один раз на процесс, а не на задачу."""
+    global _TPL_BYTES, _BUILD_CONTEXT
+    _TPL_BYTES = tpl_bytes
+    _BUILD_CONTEXT = _compile_context_builder(resolved, columns)
+
+def _render_row(args):
+    """Воркер пула процессов: рендер одного DOCX по одной строке CSV.
+
+    Рендер docxtpl чисто CPU-bound, поэтому масштабируется только
+    через отдельные процессы. Байты шаблона и сборщик контекста лежат
+    в глобалах процесса (см. _init_worker) — воркеру остается только
+    рендер. Новый DocxTemplate на каждую строку обязателен: render()
+    мутирует состояние объекта. Имя файла уже собрано векторно
+    в read_csv_strings.
+    """
+    row, output_folder, docx_name = args
+
+    doc = DocxTemplate(io.BytesIO(_TPL_BYTES))
+    doc.render(_BUILD_CONTEXT(row))
+
+    docx_path = os.path.join(output_folder, docx_name)
+
+    # Сериализуем DOCX в память и пишем на диск одним write():
+    # doc.save(path) делает массу мелких записей через zipfile
+    buf = io.BytesIO()
+    doc.save(buf)
+    with open(docx_path, 'wb') as f:
+        f.write(buf.getbuffer())
+
+    return docx_path
+
+def convert_docx_batch(docx_paths, pdf_folder):
+    """Конвертация всех DOCX в PDF одним вызовом LibreOffice.
+
+    Запуск soffice на каждый файл стоит 2-3 секунды только на старт процесса,
+    поэтому передаем весь список файлов одной командой. Если LibreOffice
+    не установлен, откатываемся на docx2pdf по одному файлу.
+    """
+    if not docx_paths:
+        return
+    soffice = shutil.which('soffice') or shutil.which('libreoffice')
+    if soffice:
+        subprocess.run(
+            [soffice, '--headless', '--convert-to', 'pdf', '--outdir', pdf_folder] + docx_paths,
+            check=True,
+            timeout=600,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    else:
+        for docx_path in docx_paths:
+            pdf_name = os.path.splitext(os.path.basename(docx_path))[0] + '.pdf'
+            convert(docx_path, os.path.join(pdf_folder, pdf_name))
+
+def dedupe_names(names):
+    """Уникализация имен выходных файлов.
+
+    Строки с одинаковыми Email и Организацией дают одно и то же имя:
+    воркеры пула писали бы в один путь параллельно (риск битого DOCX),
+    а архив получал бы дубликаты arcname. Повторам дописывается
+    суффикс с номером строки.
+    """
+    seen = set()
+    unique = []
+    for idx, name in enumerate(names):
+        if name in seen:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}_{idx}{ext}"
+            counter = 1
+            while name in seen:
+                name = f"{stem}_{idx}_{counter}{ext}"
+                counter += 1
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+def read_csv_strings(csv_path, encoding):
+    """Чтение CSV со всеми значениями-строками.
+
+    С polars и utf-8 кодировкой парсинг идет многопоточным ридером
+    (infer_schema_length=0 — все колонки строковые, без угадывания
+    типов); для прочих кодировок или без polars работаем на pandas.
+    Имена выходных файлов ({email}_{организация}.docx после очистки
+    от опасных символов) собираются здесь же векторно, чтобы воркеры
+    не гоняли sanitize_filename по каждой строке.
+    Возвращает (список колонок, список словарей-строк, список имен).
+    """
+    if pl is not None and encoding == 'utf-8':
+        df = pl.read_csv(csv_path, separator=';', encoding='utf8', infer_schema_length=0).fill_null('')
+
+        row_idx = pl.int_range(pl.len())
+        if 'Email' in df.columns:
+            email_expr = pl.col('Email').str.replace_all(_SANITIZE_RE.pattern, '_')
+        else:
+            email_expr = pl.format('row_{}', row_idx)
+        if 'Организация' in df.columns:
+            org_expr = pl.when(pl.col('Организация') != '') \
+                .then(pl.col('Организация').str.replace_all(_SANITIZE_RE.pattern, '_')) \
+                .otherwise(pl.format('doc_{}', row_idx))
+        else:
+            org_expr = pl.format('doc_{}', row_idx)
+        docx_names = df.select(pl.format('{}_{}.docx', email_expr, org_expr).alias('name'))['name'].to_list()
+
+        return df.columns, df.to_dicts(), dedupe_names(docx_names)
+
+    # dtype=str отключает угадывание типов; пустые ячейки становятся
+    # пустыми строками, как и в polars-ветке с fill_null
+    data = pd.read_csv(csv_path, sep=';', encoding=encoding, dtype=str).fillna('')
+
+    doc_labels = [f'doc_{i}' for i in range(len(data))]
+    if 'Email' in data.columns:
+        emails = data['Email'].str.replace(_SANITIZE_RE, '_', regex=True)
+    else:
+        emails = pd.Series([f'row_{i}' for i in range(len(data))], index=data.index)
+    if 'Организация' in data.columns:
+        orgs = data['Организация'].str.replace(_SANITIZE_RE, '_', regex=True)
+        orgs = orgs.mask(data['Организация'] == '', pd.Series(doc_labels, index=data.index))
+    else:
+        orgs = pd.Series(doc_labels, index=data.index)
+    docx_names = (emails + '_' + orgs + '.docx').tolist()
+
+    return list(data.columns), data.to_dict('records'), dedupe_names(docx_names)
+
+def cached_csv_encoding(file_path, content_hash=None):
+    """Детект кодировки CSV с кешем по хешу содержимого.
+
+    Хеш считается бесплатно в копирующем цикле /api/upload-stream
+    (или передается клиентом в X-CSV-Hash); без хеша просто детектим.
+    """
+    now = time.time()
+    if content_hash:
+        cached = _ENCODING_CACHE.get(content_hash)
+        if cached and now - cached[1] < _ENCODING_CACHE_TTL:
+            return cached[0]
+
+    encoding = detect_csv_encoding(file_path)
+
+    if content_hash:
+        # Заодно выбрасываем протухшие записи — кеш остается маленьким
+        for key in [k for k, (_, ts) in _ENCODING_CACHE.items() if now - ts > _ENCODING_CACHE_TTL]:
+            del _ENCODING_CACHE[key]
+        _ENCODING_CACHE[content_hash] = (encoding, now)
+    return encoding
+
 def get_csv_columns(file_path):
-    """Получение списка столбцов из CSV"""
+    """Получение списка столбцов из CSV.
+
+    Заголовок разбирается модулем csv по той же 64 КБ выборке,
+    что и детект кодировки — без инициализации парсера pandas.
+    """
     encoding = detect_csv_encoding(file_path)
     try:
-        df = pd.read_csv(file_path, sep=';', encoding=encoding, nrows=0)
-        return list(df.columns)
+        with open(file_path, 'rb') as f:
+            sample = f.read(65536)
+        text = sample.decode(encoding, errors='replace')
+        return next(csv.reader(io.StringIO(text), delimiter=';'))
     except Exception as e:
         return None
 
+def prune_uploads(now):
+    """Удаление потоковых загрузок, которые никто не забрал.
+
+    Без этого клиент, загрузивший файл и не вызвавший generate,
+    навсегда оставляет до 50 МБ в общем temp-каталоге плюс записи
+    в словарях — неограниченный рост на долгоживущем сервере.
+    """
+    for token in [t for t, (_, ts) in _UPLOADS.items() if now - ts > _UPLOAD_TTL]:
+        path, _ = _UPLOADS.pop(token)
+        _UPLOAD_HASHES.pop(token, None)
+        remove_silent(path)
+
+def take_upload(token):
+    """Изъятие потоковой загрузки по токену: (путь, хеш) или (None, None)"""
+    entry = _UPLOADS.pop(token, None)
+    content_hash = _UPLOAD_HASHES.pop(token, None)
+    if entry is None:
+        return None, None
+    return entry[0], content_hash
+
+@app.route('/api/upload-stream', methods=['POST'])
+def upload_stream():
+    """Потоковая загрузка файла в обход multipart-парсера.
+
+    Werkzeug разбирает multipart-тела на питоне, что на 50 МБ файлах
+    заметно тормозит. Здесь клиент шлет тело как application/octet-stream
+    с именем файла в заголовке X-File-Name, и байты уходят с request.stream
+    на диск кусками по 1 МБ. В ответе token, который можно передать
+    в /api/generate (template_token / csv_token) вместо самого файла.
+    """
+    try:
+        filename = request.headers.get('X-File-Name', '')
+        if not filename or not allowed_file(filename):
+            return jsonify({'error': 'Недопустимое имя файла'}), 400
+
+        token = uuid.uuid4().hex
+        file_path = os.path.join(
+            app.config['UPLOAD_FOLDER'],
+            f"{token}_{secure_filename(filename)}"
+        )
+
+        # Хешируем прямо в копирующем цикле — лишних проходов нет
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'wb') as f:
+            while True:
+                chunk = request.stream.read(1 << 20)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                f.write(chunk)
+
+        now = time.time()
+        prune_uploads(now)
+        _UPLOADS[token] = (file_path, now)
+        _UPLOAD_HASHES[token] = hasher.hexdigest()
+
+        return jsonify({'success': True, 'token': token, 'hash': _UPLOAD_HASHES[token]})
+
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при загрузке файла: {str(e)}'}), 500
+
 @app.route('/api/preview-template', methods=['POST'])
 def preview_template():
     """Получить переменные из шаблона DOCX"""
@@ -74,16 +373,15 @@ def preview_template():
         try:
             # Загружаем шаблон и извлекаем переменные
             doc = DocxTemplate(temp_path)
-            variables = list(doc.get_undeclared_variables())
-            os.remove(temp_path)
+            variables = list(doc.get_undeclared_template_variables())
+            remove_silent(temp_path)
             
             return jsonify({
                 'success': True,
                 'variables': variables
             })
         except Exception as e:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            remove_silent(temp_path)
             return jsonify({'error': f'Ошибка при чтении шаблона: {str(e)}'}), 400
     
     except Exception as e:
@@ -108,14 +406,20 @@ def preview_csv():
         csv_file.save(temp_path)
         
         try:
-            encoding = detect_csv_encoding(temp_path)
-            df = pd.read_csv(temp_path, sep=';', encoding=encoding)
-            
-            columns = list(df.columns)
-            preview_data = df.head(3).values.tolist()
-            row_count = len(df)
+            encoding = cached_csv_encoding(temp_path, request.headers.get('X-CSV-Hash'))
+
+            if pl is not None and encoding == 'utf-8':
+                df = pl.read_csv(temp_path, separator=';', encoding='utf8', infer_schema_length=0)
+                columns = df.columns
+                preview_data = [list(r) for r in df.head(3).rows()]
+                row_count = df.height
+            else:
+                df = pd.read_csv(temp_path, sep=';', encoding=encoding)
+                columns = list(df.columns)
+                preview_data = df.head(3).values.tolist()
+                row_count = len(df)
             
-            os.remove(temp_path)
+            remove_silent(temp_path)
             
             return jsonify({
                 'success': True,
@@ -124,8 +428,7 @@ def preview_csv():
                 'rowCount': row_count
             })
         except Exception as e:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            remove_silent(temp_path)
             return jsonify({'error': f'Ошибка при чтении CSV: {str(e)}'}), 400
     
     except Exception as e:
@@ -135,15 +438,25 @@ def preview_csv():
 def generate_documents():
     """Генерация документов и создание архива"""
     try:
-        # Проверка файлов
-        if 'template' not in request.files or 'csv' not in request.files:
-            return jsonify({'error': 'Шаблон и CSV обязательны'}), 400
-        
-        template_file = request.files['template']
-        csv_file = request.files['csv']
+        # Файлы приходят либо multipart-полями, либо токенами
+        # от /api/upload-stream
+        template_file = request.files.get('template')
+        csv_file = request.files.get('csv')
+        template_token = request.form.get('template_token')
+        csv_token = request.form.get('csv_token')
         mapping = request.form.get('mapping', '{}')
-        
-        if template_file.filename == '' or csv_file.filename == '':
+
+        # Какие форматы класть в архив; конвертация в PDF пропускается,
+        # если PDF не запрошен
+        formats = {f.strip().lower() for f in request.form.get('formats', 'docx,pdf').split(',') if f.strip()}
+        if not formats & {'docx', 'pdf'}:
+            return jsonify({'error': 'Недопустимый формат вывода'}), 400
+
+        if (template_file is None and not template_token) or (csv_file is None and not csv_token):
+            return jsonify({'error': 'Шаблон и CSV обязательны'}), 400
+
+        if (template_file is not None and template_file.filename == '') or \
+                (csv_file is not None and csv_file.filename == ''):
             return jsonify({'error': 'Файлы не выбраны'}), 400
         
         # Парсим маппинг
@@ -153,105 +466,135 @@ def generate_documents():
         except:
             field_mapping = {}
         
-        # Создаем временную директорию для работы
-        work_dir = tempfile.mkdtemp()
-        
-        try:
-            # Сохраняем загруженные файлы
-            template_path = os.path.join(work_dir, secure_filename(template_file.filename))
-            csv_path = os.path.join(work_dir, secure_filename(csv_file.filename))
-            
-            template_file.save(template_path)
-            csv_file.save(csv_path)
-            
-            # Загружаем данные из CSV
-            encoding = detect_csv_encoding(csv_path)
-            data = pd.read_csv(csv_path, sep=';', encoding=encoding)
-            
-            # Создаем директории для вывода
-            output_folder = os.path.join(work_dir, "output_docs")
-            pdf_folder = os.path.join(output_folder, "pdf_files")
-            os.makedirs(pdf_folder, exist_ok=True)
+        # Временная директория живет ровно в рамках запроса;
+        # контекстный менеджер убирает ее и на ошибочных путях,
+        # без ручных rmtree
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                # Сохраняем загруженные файлы (токен забирает уже
+                # сохраненный потоком файл)
+                if template_token:
+                    uploaded, _ = take_upload(template_token)
+                    if not uploaded or not os.path.exists(uploaded):
+                        return jsonify({'error': 'Токен шаблона не найден'}), 400
+                    template_path = os.path.join(work_dir, os.path.basename(uploaded))
+                    shutil.move(uploaded, template_path)
+                else:
+                    template_path = os.path.join(work_dir, secure_filename(template_file.filename))
+                    template_file.save(template_path, buffer_size=1 << 20)
+
+                csv_token_hash = None
+                if csv_token:
+                    # Хеш снимается вместе с токеном: иначе запись
+                    # остается навсегда, если клиент прислал
+                    # еще и X-CSV-Hash
+                    uploaded, csv_token_hash = take_upload(csv_token)
+                    if not uploaded or not os.path.exists(uploaded):
+                        return jsonify({'error': 'Токен CSV не найден'}), 400
+                    csv_path = os.path.join(work_dir, os.path.basename(uploaded))
+                    shutil.move(uploaded, csv_path)
+                else:
+                    csv_path = os.path.join(work_dir, secure_filename(csv_file.filename))
+                    csv_file.save(csv_path, buffer_size=1 << 20)
+
+                # Загружаем данные из CSV; кодировка берется из кеша,
+                # если CSV уже проходил через preview с тем же хешем
+                csv_hash = request.headers.get('X-CSV-Hash') or csv_token_hash
+                encoding = cached_csv_encoding(csv_path, csv_hash)
+                columns, records, docx_names = read_csv_strings(csv_path, encoding)
             
-            # Загружаем шаблон
-            doc_template = DocxTemplate(template_path)
+                # Создаем директории для вывода
+                output_folder = os.path.join(work_dir, "output_docs")
+                pdf_folder = os.path.join(output_folder, "pdf_files")
+                os.makedirs(pdf_folder, exist_ok=True)
             
-            # Генерируем документы
-            success_count = 0
-            error_list = []
+                # Набор переменных шаблона и маппинг на колонки CSV
+                # инвариантны по строкам — вычисляем один раз до цикла
+                with open(template_path, 'rb') as f:
+                    tpl_bytes = f.read()
+
+                undeclared = tuple(DocxTemplate(io.BytesIO(tpl_bytes)).get_undeclared_template_variables())
+                resolved = [(var_name, field_mapping.get(var_name, var_name)) for var_name in undeclared]
+
+                # Генерируем документы параллельно: рендер CPU-bound,
+                # поэтому раздаем строки по процессам
+                success_count = 0
+                error_list = []
+                docx_paths = []
+
+                with ProcessPoolExecutor(
+                    max_workers=os.cpu_count(),
+                    initializer=_init_worker,
+                    initargs=(tpl_bytes, resolved, tuple(columns))
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            _render_row,
+                            (row, output_folder, docx_names[idx])
+                        ): idx
+                        for idx, row in enumerate(records)
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            docx_paths.append(future.result())
+                            success_count += 1
+                        except Exception as e:
+                            error_list.append(f"Строка {futures[future] + 1}: {str(e)}")
             
-            for idx, row in data.iterrows():
-                try:
-                    # Подготавливаем контекст
-                    context = {}
-                    for var_name in doc_template.get_undeclared_variables():
-                        # Проверяем маппинг
-                        csv_column = field_mapping.get(var_name, var_name)
-                        if csv_column in row.index:
-                            context[var_name] = str(row[csv_column])
-                        else:
-                            context[var_name] = f"[{var_name}]"
-                    
-                    # Генерируем DOCX
-                    doc = DocxTemplate(template_path)
-                    doc.render(context)
-                    
-                    # Определяем имя файла
-                    email = str(row.get('Email', f'row_{idx}'))
-                    org = str(row.get('Организация', ''))
-                    safe_email = sanitize_filename(email)
-                    safe_org = sanitize_filename(org) if org else f'doc_{idx}'
-                    
-                    docx_filename = f"{safe_email}_{safe_org}.docx"
-                    docx_path = os.path.join(output_folder, docx_filename)
-                    doc.save(docx_path)
-                    
-                    # Конвертируем в PDF
+                if success_count == 0:
+                    return jsonify({'error': f'Не удалось создать документы. Ошибки: {", ".join(error_list[:3])}'}), 400
+
+                # Конвертируем в PDF всей пачкой (если PDF запрошен)
+                if 'pdf' in formats:
                     try:
-                        pdf_filename = f"{safe_email}_{safe_org}.pdf"
-                        pdf_path = os.path.join(pdf_folder, pdf_filename)
-                        convert(docx_path, pdf_path)
+                        convert_docx_batch(docx_paths, pdf_folder)
                     except:
                         # Если PDF не получился, продолжаем без него
                         pass
-                    
-                    success_count += 1
-                
-                except Exception as e:
-                    error_list.append(f"Строка {idx + 1}: {str(e)}")
-                    continue
-            
-            if success_count == 0:
-                return jsonify({'error': f'Не удалось создать документы. Ошибки: {", ".join(error_list[:3])}'}), 400
-            
-            # Создаем ZIP архив
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for root, dirs, files in os.walk(output_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, output_folder)
+
+                # Имена всех результатов уже известны из рендера — собираем
+                # архив по этому списку, без повторного обхода директории
+                outputs = []
+                if 'docx' in formats:
+                    outputs.extend((os.path.basename(p), p) for p in docx_paths)
+                if 'pdf' in formats:
+                    for p in docx_paths:
+                        pdf_name = os.path.splitext(os.path.basename(p))[0] + '.pdf'
+                        pdf_path = os.path.join(pdf_folder, pdf_name)
+                        if os.path.exists(pdf_path):
+                            outputs.append((os.path.join('pdf_files', pdf_name), pdf_path))
+
+                # Возможно только при formats=pdf и упавшей конвертации
+                # (нет LibreOffice/Word): отдать пустой архив с кодом 200
+                # было бы молчаливой потерей всех документов
+                if not outputs:
+                    return jsonify({'error': 'Не удалось сконвертировать документы в PDF. Попробуйте формат docx'}), 400
+
+                # Создаем ZIP архив: маленькие пачки остаются в памяти,
+                # большие прозрачно уходят на диск и отдаются клиенту
+                # потоково, без полного буфера в RAM. DOCX и PDF сами
+                # по себе сжатые контейнеры, поэтому ZIP_STORED: deflate
+                # тратил бы CPU почти без выигрыша в размере
+                zip_spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+                with zipfile.ZipFile(zip_spool, 'w', zipfile.ZIP_STORED) as zip_file:
+                    for arcname, file_path in outputs:
                         zip_file.write(file_path, arcname)
-            
-            zip_buffer.seek(0)
-            
-            # Очищаем временную папку
-            shutil.rmtree(work_dir)
-            
-            # Возвращаем архив
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f'documents_{timestamp}.zip'
-            
-            return send_file(
-                zip_buffer,
-                mimetype='application/zip',
-                as_attachment=True,
-                download_name=filename
-            )
+
+                zip_spool.seek(0)
+
+                # Возвращаем архив
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                filename = f'documents_{timestamp}.zip'
+
+                return send_file(
+                    zip_spool,
+                    mimetype='application/zip',
+                    as_attachment=True,
+                    download_name=filename
+                )
         
-        except Exception as e:
-            shutil.rmtree(work_dir)
-            return jsonify({'error': f'Ошибка обработки: {str(e)}'}), 400
+            except Exception as e:
+                return jsonify({'error': f'Ошибка обработки: {str(e)}'}), 400
     
     except Exception as e:
         return jsonify({'error': f'Критическая ошибка: {str(e)}'}), 500